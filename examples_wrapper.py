@@ -1,19 +1,27 @@
 #!/usr/bin/env python3
-import argparse, os, sys, time, struct, zlib, serial, re
+import argparse, os, sys, time, struct, zlib, serial, re, io, collections, queue, threading, select, errno
+
+try:  # optional: pip install zlib-ng
+    from zlib_ng.zlib_ng import crc32_combine
+except ImportError:
+    crc32_combine = None
 
 # ===== Protocol constants =====
 MAGIC_HS = b"HS20"     # handshake magic
 MAGIC_TX = b"WRP2"     # data session magic
-VER      = 2
+VER      = 5
 
-# Handshake: MAGIC_HS(4) | VER(1) | name_len(2) | total_len(8) | file_crc32(4) | name
-HS_HDR = "<4sBHQI"
+# Handshake: MAGIC_HS(4) | VER(1) | name_len(2) | total_len(8) | name
+HS_HDR = "<4sBHQ"
 
-# Data session header: MAGIC_TX(4) | VER(1) | total_len(8) | file_crc32(4)
-TX_HDR = "<4sBQI"
+# Data session header: MAGIC_TX(4) | VER(1) | total_len(8)
+TX_HDR = "<4sBQ"
 
 # Per-block: seq(2) | blen(2) | data | crc32(4)
+# End of data: seq(2) | blen=0 (2) | file_crc32(4) | crc32 of the first 8 bytes(4)
+# Sent once every block is ACKed, and resent until the final status comes back.
 BLK_HDR = "<HH"
+END_TRL = "<II"
 
 # Control bytes
 ACK = b"K"
@@ -21,20 +29,114 @@ NAK = b"N"
 FOK = b"OK"   # final OK
 FNO = b"NO"   # final fail
 
+# Per-block reply: ACK/NAK(1) | next expected seq(2)
+# ACK is cumulative (every block before seq arrived); NAK asks to resend from seq.
+CTRL_HDR = "<cH"
+
+# Precompiled layouts for the per-block hot path
+_HS   = struct.Struct(HS_HDR)
+_TX   = struct.Struct(TX_HDR)
+_BLK  = struct.Struct(BLK_HDR)
+_CTRL = struct.Struct(CTRL_HDR)
+_U32  = struct.Struct("<I")
+_END  = struct.Struct(END_TRL)
+
+# End-of-data timing (seconds): the sender resends the trailer every END_RESEND;
+# the receiver drops a half-read frame once the line has been idle for END_IDLE,
+# and gives up on a sender that stays silent for END_WAIT.
+END_RESEND = 2.0
+END_IDLE   = 0.5
+END_WAIT   = 60.0
+
 # Console markers
 CONFIRM_SEND = "Entering SEND mode"
 CONFIRM_RECV = "Entering RECEIVE mode"
 
 # Console parsing helpers
 ANSI_RE   = re.compile(rb"\x1B\[[0-9;?]*[ -/]*[@-~]")
+ANSI_TAIL = re.compile(rb"\x1B(\[[0-9;?]*[ -/]*)?\Z")  # escape cut off by a read
 PROMPT_RE = re.compile(rb"(^|\r?\n)#\s")
 
 # ===== Utilities =====
+_UNITS = ("B", "KB", "MB", "GB", "TB", "P")
 def human(n):
-    for u in ("","K","M","G","T"):
-        if n < 1024.0: return f"{n:.1f}{u}B"
-        n /= 1024.0
-    return f"{n:.1f}P"
+    # unit straight from the magnitude instead of dividing through each one
+    i = min(max(int(n).bit_length() - 1, 0) // 10, len(_UNITS) - 1)
+    return f"{n / (1 << 10*i):.1f}{_UNITS[i]}"
+
+def fold_crc(running, data, bcrc):
+    # Extend a running CRC with a block whose own CRC is already known;
+    # crc32_combine skips a second pass over the data when zlib-ng is present.
+    if crc32_combine: return crc32_combine(running, bcrc, len(data))
+    return zlib.crc32(data, running)
+
+_READ_RETRY = (errno.EAGAIN, errno.EALREADY, errno.EWOULDBLOCK, errno.EINPROGRESS, errno.EINTR)
+
+class BufferedSerial:
+    """Serial port with a pushback buffer, so scanners can read ahead in bulk
+    and return what they over-read. Anything else goes to the port."""
+    def __init__(self, ser):
+        object.__setattr__(self, "ser", ser)
+        object.__setattr__(self, "pushback", bytearray())
+        # POSIX ports expose their tty fd; Windows and URL handlers don't
+        fd = getattr(ser, "fd", None)
+        object.__setattr__(self, "raw_fd", fd if isinstance(fd, int) else None)
+
+    def __getattr__(self, name): return getattr(self.ser, name)
+    def __setattr__(self, name, value): setattr(self.ser, name, value)
+
+    @property
+    def in_waiting(self): return len(self.pushback) + self.ser.in_waiting
+
+    def read(self, n=1):
+        if not self.pushback: return self.ser.read(n)
+        out = bytes(self.pushback[:n]); del self.pushback[:n]
+        if len(out) < n and self.ser.in_waiting:
+            out += self.ser.read(min(n - len(out), self.ser.in_waiting))
+        return out
+
+    def read_ready(self, n, timeout):
+        # Up to n bytes, waiting at most `timeout` for the first. On POSIX this
+        # is a bare select + os.read, skipping pyserial's per-call overhead.
+        if self.pushback: return self.read(n)
+        if self.raw_fd is None:
+            if timeout <= 0 and not self.ser.in_waiting: return b""
+            return self.ser.read(n)  # waits up to the port timeout
+        r, _, _ = select.select([self.raw_fd], [], [], max(timeout, 0))
+        if not r: return b""
+        return self._read_fd(os.read, n) or b""
+
+    def _read_fd(self, read, arg):
+        # select() reported the fd ready; the same checks pyserial's read()
+        # makes, so a yanked adapter is a SerialException, not a timeout.
+        try: got = read(self.raw_fd, arg)
+        except OSError as e:
+            if e.errno in _READ_RETRY: return None
+            raise serial.SerialException(f"read failed: {e}")
+        if not got:
+            raise serial.SerialException(
+                "device reports readiness to read but returned no data "
+                "(device disconnected or multiple access on port?)")
+        return got
+
+    def readinto(self, mv):
+        # Fill what is available of mv; on POSIX the bytes land in it directly
+        if self.pushback:
+            n = min(len(mv), len(self.pushback))
+            mv[:n] = self.pushback[:n]; del self.pushback[:n]
+            return n
+        if self.raw_fd is None:
+            b = self.ser.read(len(mv)); mv[:len(b)] = b
+            return len(b)
+        r, _, _ = select.select([self.raw_fd], [], [], self.ser.timeout)
+        if not r: return 0
+        return self._read_fd(os.readv, [mv]) or 0
+
+    def unread(self, data): self.pushback[:0] = data
+
+    def reset_input_buffer(self):
+        self.pushback.clear()
+        self.ser.reset_input_buffer()
 
 def open_port(port, baud, timeout=0.2, write_timeout=2.0, verbose=False):
     if verbose: print(f"[dbg] Opening {port} @ {baud} (avoid reset)…")
@@ -49,20 +151,30 @@ def open_port(port, baud, timeout=0.2, write_timeout=2.0, verbose=False):
     ser.dtr = False
     ser.rts = False
     ser.open()
+    # Windows only: the default 4 KiB driver RX queue throttles bulk reads
+    if hasattr(ser, "set_buffer_size"): ser.set_buffer_size(rx_size=1 << 20)
     if verbose: print(f"[dbg] Port open. DTR={ser.dtr} RTS={ser.rts}")
-    return ser
+    return BufferedSerial(ser)
 
 def _strip_ansi(b: bytes) -> bytes: return ANSI_RE.sub(b"", b)
+def _strip_ansi_incremental(pending: bytes):
+    # Strip what can be stripped now; hold back an unfinished escape sequence.
+    m = ANSI_TAIL.search(pending)
+    cut = m.start() if m else len(pending)
+    return _strip_ansi(pending[:cut]), pending[cut:]
 def _read_some(ser): return ser.read(ser.in_waiting or 1)
 
 def read_until_prompt(ser, max_wait=2.0):
     deadline = time.time() + max_wait
-    buf = bytearray()
+    stripped = bytearray(); pending = b""
     while time.time() < deadline:
         b = _read_some(ser)
         if b:
-            buf += b
-            if PROMPT_RE.search(_strip_ansi(bytes(buf))):
+            # only search the new text, plus enough overlap for "\r\n# "
+            start = max(len(stripped) - 3, 0)
+            clean, pending = _strip_ansi_incremental(pending + b)
+            stripped += clean
+            if PROMPT_RE.search(stripped, start):
                 return True
         else:
             ser.write(b"\r\n"); ser.flush()
@@ -82,12 +194,14 @@ def try_sync_prompt(ser, verbose=False):
 
 def wait_for_token(ser, token: str, max_wait=8.0):
     deadline = time.time() + max_wait
-    buf = bytearray(); needle = token.encode()
+    stripped = bytearray(); pending = b""; needle = token.encode()
     while time.time() < deadline:
         b = _read_some(ser)
         if b:
-            buf += b
-            if needle in _strip_ansi(bytes(buf)):
+            start = max(len(stripped) - len(needle) + 1, 0)
+            clean, pending = _strip_ansi_incremental(pending + b)
+            stripped += clean
+            if stripped.find(needle, start) >= 0:
                 return True
         else:
             time.sleep(0.01)
@@ -111,43 +225,101 @@ def read_exact(ser, n) -> bytes:
         out.extend(b)
     return bytes(out)
 
-def sync_on_magic(ser, magic: bytes, max_wait=30.0):
+def read_exact_within(ser: BufferedSerial, n, idle):
+    """n bytes, or None once nothing has arrived for `idle` seconds."""
+    out = bytearray()
+    deadline = time.monotonic() + idle
+    while len(out) < n:
+        b = ser.read_ready(n - len(out), deadline - time.monotonic())
+        if b:
+            out += b; deadline = time.monotonic() + idle
+        elif time.monotonic() >= deadline:
+            return None
+    return bytes(out)
+
+def read_into_exact(ser: BufferedSerial, mv, n):
+    got = 0
+    while got < n: got += ser.readinto(mv[got:n])
+
+def sync_on_magic(ser: BufferedSerial, magic: bytes, max_wait=30.0):
     deadline = time.time() + max_wait
-    win = bytearray(); m = len(magic)
+    tail = b""; m = len(magic)
     while time.time() < deadline:
-        b = ser.read(1)
+        b = _read_some(ser)
         if not b: continue
-        win += b
-        if len(win) > m: del win[0:len(win)-m]
-        if len(win) == m and bytes(win) == magic:
+        # check the seam with the previous read on its own, so the chunk
+        # itself is searched in place instead of being copied onto the tail
+        seam = tail + b[:m-1]
+        i = seam.find(magic)
+        if i >= 0:
+            # the bytes after the magic are the header the caller reads next
+            ser.unread(seam[i+m:] + b[m-1:])
+            return True
+        i = b.find(magic)
+        if i >= 0:
+            ser.unread(b[i+m:])
             return True
+        tail = (seam if len(b) < m else b)[-(m-1):]
     return False
 
 def wait_for_ack_byte(ser, ok=ACK, bad=NAK, timeout=8.0, verbose=False):
     deadline = time.time() + timeout
     while time.time() < deadline:
-        b = ser.read(1)
+        b = _read_some(ser)
         if not b: continue
-        if b == ok:
+        # first control byte wins; stray bytes (CR/LF or console remnants) are ignored
+        i_ok, i_bad = b.find(ok), b.find(bad)
+        if i_ok >= 0 and (i_bad < 0 or i_ok < i_bad):
             if verbose: print("[dbg] Got ACK")
             return True
-        if b == bad:
+        if i_bad >= 0:
             if verbose: print("[dbg] Got NAK")
             return False
-        # ignore stray bytes (CR/LF or console remnants)
     return False
 
+def read_ctrl(ser, timeout):
+    """Next ACK/NAK frame as (tag, seq), or (None, None) on timeout."""
+    # Without a raw fd one read only waits out the port timeout, so an empty
+    # read is a timeout only once the deadline itself has passed.
+    deadline = time.monotonic() + timeout
+    tag = b""
+    while tag not in (ACK, NAK):
+        tag = ser.read_ready(1, deadline - time.monotonic())  # stray bytes are skipped
+        if not tag and time.monotonic() >= deadline: return None, None
+    # The seq bytes were written with the tag; don't leave them behind to be
+    # misread as the next frame just because the deadline fell in between.
+    deadline = max(deadline, time.monotonic() + 0.2)
+    rest = bytearray()
+    while len(rest) < 2:
+        b = ser.read_ready(2 - len(rest), deadline - time.monotonic())
+        if not b and time.monotonic() >= deadline: return None, None
+        rest += b
+    return _CTRL.unpack(tag + rest)
+
+def read_final(ser, timeout=8.0):
+    # Re-ACKs for late duplicate blocks may still arrive ahead of the status.
+    # The receiver never NAKs once all data is in, so anything else is FOK/FNO.
+    # A frame started before the deadline is read to the end, so a resend of
+    # the trailer doesn't find the tail of a re-ACK and take it for the status.
+    deadline = time.time() + timeout
+    buf = bytearray()
+    while time.time() < deadline:
+        b = ser.read(1)
+        if not b: continue
+        if not buf: deadline = max(deadline, time.time() + 0.2)
+        buf += b
+        if buf[:1] == ACK:
+            if len(buf) == _CTRL.size: del buf[:]
+        elif len(buf) == len(FOK):
+            return bytes(buf)
+    return b""
+
 # ===== Sender =====
-def sender(port, usb_baud, file_path, block, retries, verbose=False, stats_every=0.5):
+def sender(port, usb_baud, file_path, block, retries, window=8, verbose=False, stats_every=0.5):
     if not os.path.isfile(file_path):
         sys.exit(f"[-] File not found: {file_path}")
 
     total = os.path.getsize(file_path)
-    file_crc = 0
-    with open(file_path, "rb") as f:
-        for b in iter(lambda: f.read(1024*1024), b""):
-            file_crc = zlib.crc32(b, file_crc)
-    file_crc &= 0xffffffff
 
     fname = os.path.basename(file_path)
     name_bytes = fname.encode("utf-8")
@@ -156,7 +328,7 @@ def sender(port, usb_baud, file_path, block, retries, verbose=False, stats_every
 
     total_blocks = (total + block - 1) // block
     if verbose:
-        print(f"[dbg] File={fname}, size={total}, file_crc=0x{file_crc:08x}, block={block}, total_blocks={total_blocks}")
+        print(f"[dbg] File={fname}, size={total}, block={block}, total_blocks={total_blocks}")
 
     ser = open_port(port, usb_baud, verbose=verbose)
     try:
@@ -166,7 +338,7 @@ def sender(port, usb_baud, file_path, block, retries, verbose=False, stats_every
         ser.reset_input_buffer(); time.sleep(0.05); ser.reset_input_buffer()
 
         # ---- Handshake ----
-        hs = struct.pack(HS_HDR, MAGIC_HS, VER, len(name_bytes), total, file_crc) + name_bytes
+        hs = _HS.pack(MAGIC_HS, VER, len(name_bytes), total) + name_bytes
         if verbose: print(f"[dbg] Sending handshake ({len(hs)} bytes)")
         ser.write(hs); ser.flush()
 
@@ -174,21 +346,25 @@ def sender(port, usb_baud, file_path, block, retries, verbose=False, stats_every
             sys.exit("[-] Handshake not ACKed by receiver.")
 
         # ---- Session header ----
-        txh = struct.pack(TX_HDR, MAGIC_TX, VER, total, file_crc)
+        txh = _TX.pack(MAGIC_TX, VER, total)
         if verbose: print(f"[dbg] Sending session header ({len(txh)} bytes)")
         ser.write(txh); ser.flush()
 
         # ---- Transfer ----
+        # The whole-file CRC is folded in block by block and sent after the data.
         sent_bytes = 0
         seq = 0
-        t0 = time.time()
+        file_crc = 0
+        t0 = time.monotonic()
         last_print = t0
         done_blocks = 0
         last_done_blocks = 0
+        total_h = human(total)
 
-        def print_stats(force=False):
+        def print_stats(force=False, now=None):
+            # `now` lets the ACK path reuse the timestamp it just took
             nonlocal last_print, last_done_blocks
-            now = time.time()
+            if now is None: now = time.monotonic()
             if not force and (now - last_print) < stats_every:
                 return
             elapsed = max(now - t0, 1e-6)
@@ -199,7 +375,7 @@ def sender(port, usb_baud, file_path, block, retries, verbose=False, stats_every
             eta = left_blocks / max(pps, 1e-6) if total_blocks else 0.0
             if verbose:
                 line = (f"\r[TX] {done_blocks}/{total_blocks} blocks | "
-                        f"{pct:6.2f}% | {human(sent_bytes)}/{human(total)} | "
+                        f"{pct:6.2f}% | {human(sent_bytes)}/{total_h} | "
                         f"{pps:6.1f} blk/s | {human(bps)}/s | ETA {eta:5.1f}s")
             else:
                 line = (f"\r[TX] {pct:6.2f}% ({done_blocks}/{total_blocks} blocks)")
@@ -207,36 +383,143 @@ def sender(port, usb_baud, file_path, block, retries, verbose=False, stats_every
             last_print = now
             last_done_blocks = done_blocks
 
-        with open(file_path, "rb") as f:
-            while sent_bytes < total:
-                data = f.read(min(block, total - sent_bytes))
-                if not data: break
-                blen = len(data)
-                bcrc = zlib.crc32(data) & 0xffffffff
-                pkt = struct.pack(BLK_HDR, seq, blen) + data + struct.pack("<I", bcrc)
-
-                # retransmit loop
-                for attempt in range(1, retries+1):
-                    ser.write(pkt); ser.flush()
-                    ack = ser.read(1)
-                    if ack == ACK:
-                        if verbose: print(f"[dbg] seq={seq} len={blen} ACK")
-                        break
-                    if verbose: print(f"[dbg] seq={seq} len={blen} NAK/timeout (try {attempt})")
-                else:
+        # Go-back-N: up to `window` packets in flight, each built once and kept
+        # until ACKed. A producer thread stays up to two blocks ahead of the
+        # link, reading each block straight into a preallocated packet buffer
+        # (unbuffered FileIO.readinto: one read(2), no BufferedReader copy) and
+        # packing header and CRC in place; file reads and zlib release the GIL.
+        # Buffers cycle free -> ready -> in flight -> free once ACKed.
+        free, ready = queue.Queue(), queue.Queue()
+        for _ in range(window + 2):
+            free.put(bytearray(_BLK.size + block + _U32.size))
+
+        read_error = None
+
+        def produce():
+            nonlocal file_crc, read_error
+            try:
+                with io.FileIO(file_path, "r") as f:
+                    pseq, left = 0, total
+                    while left:
+                        pkt = free.get()
+                        pv = memoryview(pkt)
+                        blen = f.readinto(pv[_BLK.size:_BLK.size + min(block, left)])
+                        if not blen: break
+                        end = _BLK.size + blen
+                        data = pv[_BLK.size:end]
+                        bcrc = zlib.crc32(data) & 0xffffffff
+                        file_crc = fold_crc(file_crc, data, bcrc)
+                        _BLK.pack_into(pkt, 0, pseq, blen)
+                        _U32.pack_into(pkt, end, bcrc)
+                        ready.put((pseq, blen, pv[:end + _U32.size]))
+                        pseq = (pseq + 1) & 0xFFFF
+                        left -= blen
+            except Exception as e:  # handed to the main thread, which reports it
+                read_error = e
+            finally:
+                ready.put(None)  # end of file (or read error)
+
+        inflight = collections.deque()  # (seq, blen, frame, t_sent, resent), oldest first
+        queued = 0                      # bytes handed to the link so far
+        tries = 0                       # NAKs/timeouts in a row without progress
+        backoff = 0                     # RTO doublings, kept until a fresh sample
+        timer_start = 0.0               # retransmit timer, restarted as the window moves
+        # Retransmit timeout for the oldest unACKed block, timed from when it
+        # became the oldest: the timer restarts whenever an ACK moves the
+        # window (RFC 6298 5.3), since with a full window the host and ESP
+        # may buffer several block times ahead of the link. Until a round trip
+        # has been measured, assume two block times at the console baud (with
+        # the window full, ACKs arrive one block time apart); after that, twice
+        # the smoothed ACK round trip, doubled on each timeout up to 4x (more
+        # would leave a dead link silent for minutes before --retries runs
+        # out). The doubling stays until a block sent only once is ACKed
+        # (Karn): ACKs for resent blocks prove nothing about the round trip,
+        # and dropping the backoff on them lets a too-short RTO fire on every
+        # window. Without a raw fd to select on, the port timeout follows it so
+        # a lost ACK isn't padded out to the default 200 ms.
+        port_timeout = ser.timeout
+        srtt = None
+        rto = max(port_timeout, 2 * (_BLK.size + block + _U32.size) * 10 / usb_baud)
+
+        threading.Thread(target=produce, daemon=True).start()
+        while queued < total or inflight:
+            if len(inflight) < window and queued < total:
+                item = ready.get()
+                if item is None:
                     print()  # end the progress line
-                    sys.exit(f"[-] Too many NAKs/timeouts on block seq={seq}")
-
-                sent_bytes += blen
-                done_blocks += 1
-                seq = (seq + 1) & 0xFFFF
-                print_stats(force=False)
-
+                    if read_error:
+                        sys.exit(f"[-] Reading {fname} failed: {read_error}")
+                    sys.exit(f"[-] Could not read all of {fname} ({queued} of {total} bytes).")
+                pseq, blen, frame = item
+                ser.write(frame)  # no flush(): a tcdrain per block would stall the pipeline
+                now = time.monotonic()
+                if not inflight: timer_start = now
+                inflight.append((pseq, blen, frame, now, False))
+                queued += blen
+                seq = (pseq + 1) & 0xFFFF
+                # keep filling the window unless a reply is already waiting
+                if ser.in_waiting < _CTRL.size: continue
+
+            wait = timer_start + rto * (1 << backoff) - time.monotonic()
+            tag, nxt = read_ctrl(ser, max(wait, 0.0))
+            if tag is not None:
+                acked = (nxt - inflight[0][0]) & 0xFFFF
+                if 0 < acked <= len(inflight):
+                    now = time.monotonic()
+                    for _ in range(acked):
+                        _, blen, frame, t_sent, resent = inflight.popleft()
+                        sent_bytes += blen
+                        free.put(frame.obj)
+                    if not resent:  # Karn: resent blocks give ambiguous samples
+                        sample = now - t_sent
+                        srtt = sample if srtt is None else srtt + (sample - srtt) / 8
+                        rto = max(2 * srtt, 0.02)
+                        backoff = 0
+                        if ser.raw_fd is None and abs(rto - ser.timeout) > ser.timeout / 4:
+                            ser.timeout = rto
+                    done_blocks += acked
+                    tries = 0
+                    timer_start = now
+                    if verbose: print(f"[dbg] {tag.decode()} next={nxt} (+{acked} blocks)")
+                    print_stats(force=False, now=now)
+                # progress, or a harmless duplicate; a NAK can also cover every
+                # block in flight (its ACK was lost, the resent copy got garbled)
+                if tag == ACK or not inflight: continue
+
+            # NAK or timeout: go back to the oldest unACKed block, resend the window
+            tries += 1
+            if tag is None: backoff = min(backoff + 1, 2)
+            if tries > retries:
+                print()  # end the progress line
+                sys.exit(f"[-] Too many NAKs/timeouts on block seq={inflight[0][0]}")
+            if verbose:
+                why = "NAK" if tag == NAK else "timeout"
+                print(f"[dbg] {why}: resending {len(inflight)} blocks from seq={inflight[0][0]} (try {tries})")
+            for _, _, frame, _, _ in inflight:
+                ser.write(frame)
+            now = time.monotonic()
+            timer_start = now
+            inflight = collections.deque((s, n, fr, now, True) for s, n, fr, _, _ in inflight)
         print_stats(force=True); print()
+        # ---- End of data: whole-file CRC ----
+        ser.timeout = port_timeout
+        file_crc &= 0xffffffff
+        end = _BLK.pack(seq, 0) + _U32.pack(file_crc)
+        end += _U32.pack(zlib.crc32(end))
+
         # ---- Final status from receiver ----
-        final = ser.read(2)
+        # The trailer isn't ACKed like a block; a lost or garbled one is
+        # simply sent again until the receiver answers.
+        final = b""
+        for _ in range(retries + 1):
+            if verbose: print(f"[dbg] Sending end of data, file_crc=0x{file_crc:08x}")
+            ser.write(end); ser.flush()
+            final = read_final(ser, END_RESEND)
+            if final: break
+        if not final:
+            sys.exit("[-] No final status from receiver.")
         if final != FOK:
-            sys.exit("[-] Receiver reported final CRC failure.")
+            sys.exit("[-] Receiver reported failure (final CRC mismatch or write error).")
         print("[+] Transfer complete and verified by receiver.")
     finally:
         ser.close()
@@ -254,9 +537,9 @@ def receiver(port, usb_baud, out_path_or_dir, block, verbose=False, stats_every=
             sys.exit("[-] Timeout waiting for handshake magic (HS20).")
 
         # Read rest of HS header (we already consumed MAGIC_HS)
-        hs_rest_len = struct.calcsize(HS_HDR) - len(MAGIC_HS)
+        hs_rest_len = _HS.size - len(MAGIC_HS)
         hs_rest = read_exact(ser, hs_rest_len)
-        magic, ver, name_len, total, file_crc = struct.unpack(HS_HDR, MAGIC_HS + hs_rest)
+        magic, ver, name_len, total = _HS.unpack(MAGIC_HS + hs_rest)
         if ver != VER:
             sys.exit(f"[-] Bad handshake version: got {ver}, expected {VER}")
         name = read_exact(ser, name_len).decode("utf-8", errors="replace")
@@ -268,16 +551,16 @@ def receiver(port, usb_baud, out_path_or_dir, block, verbose=False, stats_every=
         out_path = out_path_or_dir if not os.path.isdir(out_path_or_dir) else os.path.join(out_path_or_dir, name)
         tmp_path = out_path + ".part"
         if verbose:
-            print(f"[dbg] Handshake OK: name={name!r}, total={total}, file_crc=0x{file_crc:08x}")
+            print(f"[dbg] Handshake OK: name={name!r}, total={total}")
             print(f"[dbg] Writing to: {tmp_path}")
 
         # Sync to session header magic, then parse
         if not sync_on_magic(ser, MAGIC_TX, max_wait=5.0):
             sys.exit("[-] Timeout waiting for data session magic (WRP2).")
-        tx_rest_len = struct.calcsize(TX_HDR) - len(MAGIC_TX)
+        tx_rest_len = _TX.size - len(MAGIC_TX)
         tx_rest = read_exact(ser, tx_rest_len)
-        magic2, ver2, total2, file_crc2 = struct.unpack(TX_HDR, MAGIC_TX + tx_rest)
-        if ver2 != VER or total2 != total or file_crc2 != file_crc:
+        magic2, ver2, total2 = _TX.unpack(MAGIC_TX + tx_rest)
+        if ver2 != VER or total2 != total:
             sys.exit("[-] Data session header mismatch.")
 
         total_blocks = (total + block - 1) // block
@@ -286,13 +569,16 @@ def receiver(port, usb_baud, out_path_or_dir, block, verbose=False, stats_every=
         rcvd = 0
         done_blocks = 0
         expect_seq = 0
-        t0 = time.time()
+        running = 0       # whole-file CRC of the blocks accepted so far
+        nak_sent = False  # one NAK per gap; the sender resends the whole window
+        t0 = time.monotonic()
         last_print = t0
         last_done_blocks = 0
+        total_h = human(total)
 
         def print_stats(force=False):
             nonlocal last_print, last_done_blocks
-            now = time.time()
+            now = time.monotonic()
             if not force and (now - last_print) < stats_every:
                 return
             elapsed = max(now - t0, 1e-6)
@@ -303,7 +589,7 @@ def receiver(port, usb_baud, out_path_or_dir, block, verbose=False, stats_every=
             eta = left_blocks / max(pps, 1e-6) if total_blocks else 0.0
             if verbose:
                 line = (f"\r[RX] {done_blocks}/{total_blocks} blocks | "
-                        f"{pct:6.2f}% | {human(rcvd)}/{human(total)} | "
+                        f"{pct:6.2f}% | {human(rcvd)}/{total_h} | "
                         f"{pps:6.1f} blk/s | {human(bps)}/s | ETA {eta:5.1f}s")
             else:
                 line = (f"\r[RX] got frame seq={expect_seq-1:5d} "
@@ -312,37 +598,112 @@ def receiver(port, usb_baud, out_path_or_dir, block, verbose=False, stats_every=
             last_print = now
             last_done_blocks = done_blocks
 
-        with open(tmp_path, "wb") as f:
-            while rcvd < total:
-                bh = read_exact(ser, struct.calcsize(BLK_HDR))
-                seq, blen = struct.unpack(BLK_HDR, bh)
-                data = read_exact(ser, blen)
-                bcrc = struct.unpack("<I", read_exact(ser, 4))[0]
-
-                ok = (seq == expect_seq) and ((zlib.crc32(data) & 0xffffffff) == bcrc)
-                if ok:
-                    f.write(data)
-                    rcvd += blen
-                    done_blocks += 1
-                    ser.write(ACK)
-                    expect_seq = (expect_seq + 1) & 0xFFFF
-                    print_stats(force=False)
-                else:
-                    ser.write(NAK)
-                    if verbose:
-                        have = zlib.crc32(data) & 0xffffffff
-                        print(f"\n[dbg] NAK: seq={seq} (expect {expect_seq}) "
-                              f"or bad block CRC (got 0x{have:08x}, want 0x{bcrc:08x})")
+        # Disk writes and the running file CRC happen on a writer thread: the
+        # ACK goes out as soon as a block checks out, and reading the next
+        # block from the port overlaps writing the previous one.
+        # Blocks are read straight into a pool of preallocated buffers, sized
+        # for the largest length a block header can carry; the writer hands
+        # each one back once it is on disk.
+        writes = queue.Queue(maxsize=8)
+        free = queue.Queue()
+        for _ in range(writes.maxsize + 2): free.put(bytearray(0xFFFF))
+        write_error = None
+
+        def write_blocks(f):
+            nonlocal running, write_error
+            while True:
+                item = writes.get()
+                if item is None:
+                    # Close (and so flush) the file here: up to eight ACKed
+                    # blocks may still sit in its buffer, and a full disk must
+                    # end up in write_error rather than escape from close()
+                    # when the with block exits.
+                    try: f.close()
+                    except OSError as e: write_error = write_error or e
+                    return
+                buf, blen, bcrc = item
+                if not write_error:
+                    with memoryview(buf)[:blen] as data:
+                        try:
+                            f.write(data)
+                            running = fold_crc(running, data, bcrc)
+                        except OSError as e:
+                            write_error = e
+                free.put(buf)
+
+        # Room for several blocks, so consecutive ones go out in one write(2)
+        with open(tmp_path, "wb", buffering=max(block, 1) * 8) as f:
+            writer = threading.Thread(target=write_blocks, args=(f,), daemon=True)
+            writer.start()
+            try:
+                buf = None
+                while True:
+                    if rcvd < total:
+                        hdr = read_exact(ser, _BLK.size)
+                        seq, blen = _BLK.unpack(hdr)
+                    else:
+                        # All data is in: only late duplicates and the trailer
+                        # (resent until we answer) can follow. Reads are bounded,
+                        # so a header garbled into a bogus length is dropped once
+                        # the line goes quiet. Nothing here is ever NAKed.
+                        hdr = read_exact_within(ser, _BLK.size, END_WAIT)
+                        if hdr is None:
+                            sys.exit("[-] Timeout waiting for end of data.")
+                        seq, blen = _BLK.unpack(hdr)
+                        if blen:
+                            if read_exact_within(ser, blen + _U32.size, END_IDLE) is not None:
+                                ser.write(_CTRL.pack(ACK, expect_seq))
+                            continue
+                        trl = read_exact_within(ser, _END.size, END_IDLE)
+                        if trl is None: continue
+                        file_crc, tcrc = _END.unpack(trl)
+                        if seq == expect_seq and zlib.crc32(hdr + trl[:_U32.size]) == tcrc:
+                            break
+                        if verbose: print("\n[dbg] Bad end-of-data frame, waiting for a resend")
+                        continue
+                    if buf is None: buf = free.get()
+                    mv = memoryview(buf)
+                    read_into_exact(ser, mv, blen)
+                    bcrc = _U32.unpack(read_exact(ser, _U32.size))[0]
+
+                    have = zlib.crc32(mv[:blen]) & 0xffffffff
+                    if have == bcrc and seq == expect_seq:
+                        expect_seq = (expect_seq + 1) & 0xFFFF
+                        nak_sent = False
+                        ser.write(_CTRL.pack(ACK, expect_seq))
+                        writes.put((buf, blen, have))
+                        buf = None
+                        rcvd += blen
+                        done_blocks += 1
+                        print_stats(force=False)
+                    elif have == bcrc or nak_sent:
+                        # Duplicate or out-of-order block: re-ACK what we have
+                        ser.write(_CTRL.pack(ACK, expect_seq))
+                    else:
+                        ser.write(_CTRL.pack(NAK, expect_seq))
+                        nak_sent = True
+                        if verbose:
+                            print(f"\n[dbg] NAK: seq={seq} (expect {expect_seq}) "
+                                  f"bad block CRC (got 0x{have:08x}, want 0x{bcrc:08x})")
+            finally:
+                writes.put(None)
+                writer.join()
 
         print_stats(force=True); print()
+        if write_error:
+            ser.write(FNO); ser.flush()
+            sys.exit(f"[-] Writing {tmp_path} failed: {write_error}")
 
         # Final whole-file CRC
-        d = open(tmp_path, "rb").read()
-        final = zlib.crc32(d) & 0xffffffff
+        final = running & 0xffffffff
         print(f"[+] Final CRC local=0x{final:08x}, expected=0x{file_crc:08x}")
         if final == file_crc:
-            if os.path.exists(out_path): os.remove(out_path)
-            os.rename(tmp_path, out_path)
+            try:
+                if os.path.exists(out_path): os.remove(out_path)
+                os.rename(tmp_path, out_path)
+            except OSError as e:
+                ser.write(FNO); ser.flush()
+                sys.exit(f"[-] Saving {out_path} failed: {e}. Keeping .part")
             ser.write(FOK); ser.flush()
             print(f"[+] Saved to {out_path}")
         else:
@@ -362,7 +723,8 @@ def main():
     ap.add_argument("--port", required=True, help="ESP USB serial (e.g., /dev/ttyUSB0 or COM7)")
     ap.add_argument("--usb-baud", type=int, default=115200, help="ESP USB console baud (Serial.begin on device)")
     ap.add_argument("--block", type=int, default=16384, help="Block size (default 16 KiB)")
-    ap.add_argument("--retries", type=int, default=6, help="Max retransmits per block (sender)")
+    ap.add_argument("--retries", type=int, default=6, help="Max window retransmits without progress (sender)")
+    ap.add_argument("--window", type=int, default=8, help="Blocks in flight before waiting for an ACK (sender)")
     ap.add_argument("--file", help="File to send (with --send)")
     ap.add_argument("--output", help="Output path or directory (with --receive)")
     ap.add_argument("-v", "--verbose", action="store_true", help="Show rich live stats and debug")
@@ -371,11 +733,13 @@ def main():
 
     if args.send and not args.file: ap.error("--send requires --file")
     if args.receive and not args.output: ap.error("--receive requires --output")
+    if not 1 <= args.block <= 65535: ap.error("--block must be between 1 and 65535")
+    if not 1 <= args.window < 32768: ap.error("--window must be between 1 and 32767")
 
     try:
         if args.send:
             sender(args.port, args.usb_baud, args.file, args.block, args.retries,
-                   verbose=args.verbose, stats_every=args.stats_every)
+                   window=args.window, verbose=args.verbose, stats_every=args.stats_every)
         else:
             receiver(args.port, args.usb_baud, args.output, args.block,
                      verbose=args.verbose, stats_every=args.stats_every)